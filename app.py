@@ -1,9 +1,10 @@
 import streamlit as st
 import pandas as pd
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 import json
 import os
+import time
+from collections import ChainMap
+from itertools import chain
 import numpy as np 
 
 # --- Configurações Iniciais ---
@@ -24,10 +25,9 @@ def get_service_account_credentials():
     """
     Constrói o JSON de credenciais a partir das variáveis de ambiente.
     """
-    if not all([CLIENT_EMAIL, PRIVATE_KEY]):
-        st.error("Erro de configuração: Credenciais do Google Cloud não encontradas.")
-        st.stop()
-        
+    # Import tardio: o custo só é pago na primeira chamada (resultado fica em cache_resource)
+    from oauth2client.service_account import ServiceAccountCredentials
+    
     creds_info = {
         "type": os.getenv("GCP_SA_TYPE"),
         "project_id": os.getenv("GCP_SA_PROJECT_ID"),
@@ -46,95 +46,183 @@ def get_service_account_credentials():
     creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_info, scope)
     return creds
 
-# **NOTA:** Removido o TTL! Esta função será executada toda vez que o Streamlit for re-executado.
-# Usamos cache SEM TTL para evitar que ela seja re-executada em interações como mudança de selectbox
-@st.cache_data(show_spinner=False) 
-def load_data_from_gsheets(sheet_name):
-    """Conecta ao Google Sheets e carrega os dados de uma aba específica."""
+@st.cache_resource
+def get_gspread_client():
+    """Autoriza o gspread uma única vez por processo e reaproveita a sessão HTTP entre as cargas."""
+    # Import tardio: não atrasa a renderização inicial da página
+    import gspread
+    
+    return gspread.authorize(get_service_account_credentials())
+
+# Abas lidas da planilha, na ordem em que são devolvidas por load_all_sheets
+SHEET_NAMES = ['ingredientes_mestres', 'receitas_bases', 'receitas_finais', 'tabela_precos_mercado']
+
+# Colunas de nomes únicos por linha (chaves de dict/merge) guardadas como string do PyArrow
+NAME_COLUMNS = ['NOME_ITEM', 'PRODUTO']
+
+# Colunas de baixa cardinalidade (nomes que se repetem em várias linhas) guardadas como category
+CATEGORY_COLUMNS = ['NOME_INGREDIENTE', 'NOME_BASE', 'NOME_BOLO']
+
+def build_dataframe_from_values(values):
+    """Monta um DataFrame a partir da matriz de valores (1ª linha = cabeçalho) devolvida pelo Sheets."""
+    if not values:
+        return pd.DataFrame()
+
+    # Converte nomes de colunas para maiúsculas e remove espaços
+    header = [str(col).upper().strip() for col in values[0]]
+
+    # Construção direta a partir da lista de listas (sem dicts por linha).
+    # A API omite as células vazias no fim de cada linha; completa com '' como o get_all_records
+    df = pd.DataFrame(values[1:]).reindex(columns=range(len(header))).fillna('')
+    df.columns = header
+
+    # Buffers contíguos do Arrow: map, groupby e comparações rodam em C, sem objetos Python por célula
+    name_columns = [col for col in NAME_COLUMNS if col in df.columns]
+    df[name_columns] = df[name_columns].astype('string[pyarrow]')
+
+    # Categorias: cada valor repetido vira um código inteiro pequeno (groupby/factorize comparam códigos, não strings)
+    category_columns = [col for col in CATEGORY_COLUMNS if col in df.columns]
+    df[category_columns] = df[category_columns].astype('category')
+    return df
+
+# Intervalo (em segundos) de recarga quando a revisão da planilha não pode ser consultada
+REVISION_FALLBACK_SECONDS = 600
+
+# Consulta leve (só metadados do Drive), refeita no máximo uma vez por minuto
+@st.cache_data(ttl=60, show_spinner=False)
+def get_sheet_revision():
+    """Devolve a data da última alteração da planilha, usada como chave dos caches em disco."""
+    try:
+        return get_gspread_client().get_file_drive_metadata(SHEET_ID)['modifiedTime']
+    
+    except Exception:
+        # Sem a API do Drive habilitada (a leitura só precisa da API do Sheets): a chave passa a
+        # mudar a cada REVISION_FALLBACK_SECONDS, como o antigo ttl=600, em vez de interromper o app
+        return f"intervalo-{int(time.time() // REVISION_FALLBACK_SECONDS)}"
+
+@st.cache_resource
+def get_last_sheet_revision():
+    """Guarda (por processo) a última revisão carregada, para descartar as cargas antigas do disco."""
+    return {'revision': None}
+
+def discard_stale_sheet_caches(sheet_revision):
+    """Apaga as cargas de revisões anteriores quando a planilha muda (o cache em disco não respeita max_entries)."""
+    last = get_last_sheet_revision()
+    if last['revision'] not in (None, sheet_revision):
+        load_all_sheets.clear()
+    last['revision'] = sheet_revision
+
+# **NOTA:** Removido o TTL! Usamos cache SEM TTL para evitar que ela seja re-executada em interações como mudança de selectbox.
+# persist="disk" mantém o cache entre reinícios do container; a chave é a revisão da planilha,
+# então qualquer edição no Sheets gera uma nova carga (o botão de atualizar força a recarga).
+# max_entries=1 limita a camada em memória; as cópias em disco de revisões antigas são apagadas por discard_stale_sheet_caches
+@st.cache_data(persist="disk", show_spinner=False, max_entries=1)
+def load_all_sheets(sheet_revision):
+    """Conecta ao Google Sheets e carrega todas as abas em uma única chamada (batchGet)."""
     try:
-        # Pega as credenciais (que estão em cache_resource)
-        creds = get_service_account_credentials()
-        client = gspread.authorize(creds)
+        # Pega o cliente já autorizado (que está em cache_resource)
+        client = get_gspread_client()
         spreadsheet = client.open_by_key(SHEET_ID)
-        worksheet = spreadsheet.worksheet(sheet_name)
-        
-        data = worksheet.get_all_records()
-        df = pd.DataFrame(data)
-        
-        # Converte nomes de colunas para maiúsculas e remove espaços
-        df.columns = [col.upper().strip() for col in df.columns]
-        
-        return df
+
+        # Uma única requisição HTTP para todas as abas, em vez de uma por aba
+        response = spreadsheet.values_batch_get([f"'{sheet_name}'" for sheet_name in SHEET_NAMES])
+        value_ranges = response.get('valueRanges', [])
+
+        return tuple(build_dataframe_from_values(value_range.get('values', [])) for value_range in value_ranges)
     
     except Exception as e:
-        st.error(f"Erro ao carregar dados da aba {sheet_name}. Verifique se o e-mail da Service Account tem acesso à planilha. Detalhes: {e}")
+        st.error(f"Erro ao carregar dados das abas {', '.join(SHEET_NAMES)}. Verifique se o e-mail da Service Account tem acesso à planilha. Detalhes: {e}")
         st.stop()
 
 # --- Funções de Processamento de Dados (Calculo de Custo de Insumos) ---
 
-def sanitize_and_convert(df, column_name):
-    """Limpa e converte colunas de valores para float."""
-    if column_name not in df.columns:
-        return df 
-        
-    # Versão mais segura e limpa
-    df[column_name] = df[column_name].astype(str).str.replace('R$', '', regex=False).str.replace('.', '', regex=False).str.replace(',', '.', regex=False).str.strip()
-    df[column_name] = pd.to_numeric(df[column_name], errors='coerce').fillna(0.0)
-    return df
+# Caracteres removidos dos valores em Real: 'R', '$' e o separador de milhar
+CURRENCY_STRIP_PATTERN = r'[R$.]'
+
+def sanitize_currency_series(series):
+    """Limpa uma Series de valores em Real e converte para número (valores inválidos viram 0.0)."""
+    # Uma única regex (kernel do PyArrow) no lugar da cadeia de .str.replace; depois troca a vírgula decimal por ponto
+    cleaned = (
+        series.astype('string[pyarrow]')
+        .str.replace(CURRENCY_STRIP_PATTERN, '', regex=True)
+        .str.replace(',', '.', regex=False)
+        .str.strip()
+    )
+    return pd.to_numeric(cleaned, errors='coerce').fillna(0.0)
 
 def calculate_master_ingredient_cost(df_ingredientes):
     """Calcula o custo unitário (por G, ML ou UN) de cada ingrediente mestre."""
     
-    df = df_ingredientes.copy()
-    df = sanitize_and_convert(df, 'VALOR_PACOTE')
-    
-    df['QUANT_PACOTE'] = pd.to_numeric(df['QUANT_PACOTE'], errors='coerce').fillna(1).replace(0, 1)
+    # Trabalha só com as colunas necessárias, sem copiar nem alterar a tabela de entrada
+    valor_pacote = sanitize_currency_series(df_ingredientes['VALOR_PACOTE']).to_numpy()
+    quant_pacote = pd.to_numeric(df_ingredientes['QUANT_PACOTE'], errors='coerce').fillna(1).to_numpy()
     
-    df['CUSTO_UNITARIO'] = df['VALOR_PACOTE'] / df['QUANT_PACOTE']
+    # Pacotes com quantidade 0 dividem por 1 (máscara NumPy na própria divisão, sem um replace a mais)
+    custo_unitario = valor_pacote / np.where(quant_pacote == 0, 1.0, quant_pacote)
     
-    df = df[['NOME_ITEM', 'UNIDADE_PACOTE', 'CUSTO_UNITARIO']]
-    df.columns = ['NOME_INGREDIENTE', 'UNIDADE_BASE', 'CUSTO_UNITARIO']
+    # O dicionário sai direto dos arrays, sem montar um Index
+    custo_dict = dict(zip(df_ingredientes['NOME_ITEM'].tolist(), custo_unitario.tolist()))
     
-    custo_dict = df.set_index('NOME_INGREDIENTE')['CUSTO_UNITARIO'].to_dict()
-    unidade_dict = df.set_index('NOME_INGREDIENTE')['UNIDADE_BASE'].to_dict()
+    return custo_dict
+
+def sum_by_key(df, key_col, value_col):
+    """Soma value_col por key_col em uma única passada O(N): códigos do factorize + np.bincount."""
+    codes, uniques = pd.factorize(df[key_col], sort=True)
+    valid = codes >= 0  # chaves vazias (NA) ficam de fora, como no groupby
     
-    return custo_dict, unidade_dict
+    sums = np.bincount(codes[valid], weights=df[value_col].to_numpy()[valid], minlength=len(uniques))
+    return dict(zip(uniques.tolist(), sums.tolist()))
 
 def calculate_recipe_cost(df_receitas, custo_dict, receita_col_name):
     """Calcula o custo total de uma base ou receita final, e retorna o detalhe."""
     
-    df = df_receitas.copy()
+    # Copia só as colunas usadas, não a tabela inteira
+    df = df_receitas[[receita_col_name, 'NOME_INGREDIENTE', 'QUANT_RECEITA']].copy()
     df['QUANT_RECEITA'] = pd.to_numeric(df['QUANT_RECEITA'], errors='coerce').fillna(0)
 
-    def calc_ingrediente_custo(row):
-        nome_ingrediente = row['NOME_INGREDIENTE']
-        quantidade_receita = row['QUANT_RECEITA']
-        custo_unitario = custo_dict.get(nome_ingrediente)
-        
-        if custo_unitario is None:
-            return 0.0
-        
-        return custo_unitario * quantidade_receita
-
-    df['CUSTO_UNITARIO'] = df['NOME_INGREDIENTE'].apply(lambda x: custo_dict.get(x, 0.0))
-    df['CUSTO_ITEM'] = df.apply(calc_ingrediente_custo, axis=1)
+    # Custo unitário buscado uma vez por ingrediente distinto e espalhado pelas linhas via códigos
+    # (ingredientes sem custo ficam com 0.0)
+    ing_codes, ing_uniques = pd.factorize(df['NOME_INGREDIENTE'], use_na_sentinel=False)
+    custo_lut = np.array([custo_dict.get(nome, 0.0) for nome in ing_uniques], dtype=np.float64)
+    df['CUSTO_UNITARIO'] = custo_lut[ing_codes]
+    df['CUSTO_ITEM'] = df['CUSTO_UNITARIO'].to_numpy() * df['QUANT_RECEITA'].to_numpy()
 
-    custo_total_receita_dict = df.groupby(receita_col_name)['CUSTO_ITEM'].sum().to_dict()
+    custo_total_receita_dict = sum_by_key(df, receita_col_name, 'CUSTO_ITEM')
     
     return custo_total_receita_dict, df 
 
-# Função Wrapper para o cálculo completo, SEM CACHE
-# Será executada na abertura da página ou ao clicar no botão
-def get_all_calculated_data():
+def build_base_display_frame(df_base):
+    """Monta a tabela de exibição (arredondada e renomeada) dos ingredientes de uma base."""
+    
+    # Um único round nas duas colunas de custo (já devolve um DataFrame novo, sem .copy())
+    df_base_display = df_base[['NOME_INGREDIENTE', 'QUANT_RECEITA', 'CUSTO_UNITARIO', 'CUSTO_ITEM']].round({'CUSTO_UNITARIO': 4, 'CUSTO_ITEM': 4})
+    df_base_display.columns = ['Ingrediente Mestre', 'Qtd na Receita (G/ML/UN)', 'Custo/Unidade (R$)', 'Custo Total na Base (R$)']
+    return df_base_display
+
+def build_final_display_frame(df_bolo, rendimento_bases):
+    """Monta a tabela de exibição dos itens (ingredientes e bases) de um bolo final."""
+    
+    # Um único round nas duas colunas de custo (já devolve um DataFrame novo, sem .copy())
+    df_display = df_bolo[['NOME_INGREDIENTE', 'QUANT_RECEITA', 'CUSTO_UNITARIO', 'CUSTO_ITEM']].round({'CUSTO_UNITARIO': 4, 'CUSTO_ITEM': 4})
+    
+    is_base = df_display['NOME_INGREDIENTE'].isin(rendimento_bases.keys())
+    df_display.insert(2, 'Tipo de Item', np.where(is_base, 'Base', 'Ingrediente Mestre/Final'))
+    
+    df_display.columns = ['Item/Base Usada', 'Qtd na Receita', 'Tipo', 'Custo/Unidade Base (R$)', 'Custo Total do Item (R$)']
+    return df_display
+
+# Função Wrapper para o cálculo completo, com cache por revisão da planilha
+# Será recalculada apenas quando a planilha mudar ou ao clicar no botão.
+# cache_resource devolve o mesmo objeto a todas as sessões (cache_data desserializaria uma cópia a cada rerun);
+# a interface só lê esses dados. A persistência em disco fica com load_all_sheets, então um reinício não refaz a busca no Sheets
+@st.cache_resource(show_spinner=False, max_entries=1)
+def get_all_calculated_data(sheet_revision):
     """Carrega todos os dados, calcula os custos intermediários e finais, e adiciona o preço de venda de mercado."""
     
-    # 1. Carregar Dados de Receitas (Busca no Sheets)
-    df_ingredientes = load_data_from_gsheets('ingredientes_mestres')
-    df_bases = load_data_from_gsheets('receitas_bases')
-    df_finais = load_data_from_gsheets('receitas_finais')
+    # 1. Carregar Dados de Receitas e a Tabela de Preços de Mercado (uma única busca no Sheets)
+    df_ingredientes, df_bases, df_finais, df_precos_mercado_bruto = load_all_sheets(sheet_revision)
     
-    # 2. Carregar a Tabela de Preços de Mercado
-    df_precos_mercado_bruto = load_data_from_gsheets('tabela_precos_mercado')
+    # 2. Validar a Tabela de Preços de Mercado
     
     COL_PRODUTO_KEY = 'PRODUTO'
     
@@ -150,90 +238,115 @@ def get_all_calculated_data():
         
     COL_PRECO_KEY = colunas_disponiveis[1]
 
-    # Cria o DF de preço usando a 1ª e 2ª coluna.
-    df_precos_mercado = df_precos_mercado_bruto[[COL_PRODUTO_KEY, COL_PRECO_KEY]].copy()
-    
-    # Renomeia para o nome padronizado para o merge
-    df_precos_mercado.rename(columns={COL_PRECO_KEY: 'PRECO_VENDA_FINAL', COL_PRODUTO_KEY: 'PRODUTO'}, inplace=True)
-    df_precos_mercado = sanitize_and_convert(df_precos_mercado, 'PRECO_VENDA_FINAL')
+    # Dicionário produto -> preço de venda usando a 1ª e 2ª coluna (sem montar um DF intermediário)
+    precos_venda = sanitize_currency_series(df_precos_mercado_bruto[COL_PRECO_KEY])
+    preco_venda_dict = dict(zip(df_precos_mercado_bruto[COL_PRODUTO_KEY].tolist(), precos_venda.tolist()))
     
     # 3. Calcular Custos
-    custo_ingredientes_dict, unidade_ingredientes_dict = calculate_master_ingredient_cost(df_ingredientes)
+    custo_ingredientes_dict = calculate_master_ingredient_cost(df_ingredientes)
     custo_bases_dict, df_bases_detalhe = calculate_recipe_cost(df_bases, custo_ingredientes_dict, receita_col_name='NOME_BASE')
     
-    df_rendimento = df_bases[['NOME_BASE', 'RENDIMENTO_FINAL_UNIDADES']].drop_duplicates()
-    df_rendimento['RENDIMENTO_FINAL_UNIDADES'] = pd.to_numeric(df_rendimento['RENDIMENTO_FINAL_UNIDADES'], errors='coerce').fillna(1).replace(0, 1)
-    rendimento_bases = df_rendimento.set_index('NOME_BASE')['RENDIMENTO_FINAL_UNIDADES'].to_dict()
+    # Um rendimento por base: conversão numérica antes do groupby, para que o first() pule as células vazias
+    rendimento_bases = (
+        pd.to_numeric(df_bases['RENDIMENTO_FINAL_UNIDADES'], errors='coerce')
+        .groupby(df_bases['NOME_BASE'], sort=False, observed=True).first()
+        .fillna(1).replace(0, 1).to_dict()
+    )
     
-    custo_bases_ajustado_dict = {}
-    for base, custo in custo_bases_dict.items():
-        rendimento = rendimento_bases.get(base, 1)
-        custo_bases_ajustado_dict[base] = custo / rendimento
+    # Divisão alinhada pelo nome da base. rendimento_bases já troca vazio/0 por 1 e tem as mesmas bases
+    # que custo_bases_dict (as duas saem de df_bases['NOME_BASE']), então o reindex não gera NaN
+    s_custo_bases = pd.Series(custo_bases_dict, dtype=float)
+    s_rendimento = pd.Series(rendimento_bases, dtype=float).reindex(s_custo_bases.index)
+    custo_bases_ajustado_dict = (s_custo_bases / s_rendimento).to_dict()
         
-    custo_total_dict = {**custo_ingredientes_dict, **custo_bases_ajustado_dict}
+    # ChainMap evita copiar os ingredientes e deixa explícita a precedência das bases em caso de nome repetido
+    custo_total_dict = ChainMap(custo_bases_ajustado_dict, custo_ingredientes_dict)
     custo_finais_dict, df_finais_detalhe = calculate_recipe_cost(df_finais, custo_total_dict, receita_col_name='NOME_BOLO')
     
     # 4. Compilar o DataFrame FINAL
-    df_receitas_finais = pd.DataFrame(custo_finais_dict.items(), columns=['Produto', 'Custo Total de Insumos (R$)'])
-    df_receitas_finais['Tipo'] = 'Bolo Final (Especial)'
-
-    df_bases_precificacao = pd.DataFrame(custo_bases_ajustado_dict.items(), columns=['Produto', 'Custo Total de Insumos (R$)'])
-    df_bases_precificacao['Tipo'] = 'Bolo Comum (Base)'
-
-    df_precificacao_completa = pd.concat([df_receitas_finais, df_bases_precificacao], ignore_index=True)
-    
-    # FIX CRÍTICO DE CASE SENSITIVITY
-    df_precificacao_completa.rename(columns={'Produto': 'PRODUTO'}, inplace=True) 
+    # Bolos finais e bases montados em um único DataFrame (sem concat); 'Tipo' como categoria de dois valores
+    n_finais, n_bases = len(custo_finais_dict), len(custo_bases_ajustado_dict)
+    df_precificacao_completa = pd.DataFrame({
+        'PRODUTO': list(custo_finais_dict) + list(custo_bases_ajustado_dict),
+        'Custo Total de Insumos (R$)': np.fromiter(
+            chain(custo_finais_dict.values(), custo_bases_ajustado_dict.values()), dtype=np.float64, count=n_finais + n_bases
+        ),
+        'Tipo': pd.Categorical.from_codes(
+            np.repeat([0, 1], [n_finais, n_bases]), categories=['Bolo Final (Especial)', 'Bolo Comum (Base)']
+        ),
+    })
     
     df_precificacao_completa['Custo Total de Insumos (R$)'] = df_precificacao_completa['Custo Total de Insumos (R$)'].round(2)
     
-    # 5. Merge com os preços de venda fixos
-    df_precificacao_completa = pd.merge(
-        df_precificacao_completa, 
-        df_precos_mercado[['PRODUTO', 'PRECO_VENDA_FINAL']], 
-        on='PRODUTO', 
-        how='left'
-    )
-    
-    # Renomeia a coluna e trata NaN (produtos sem preço definido)
-    df_precificacao_completa.rename(columns={'PRECO_VENDA_FINAL': 'Preço de Venda (Mercado) (R$)'}, inplace=True)
-    df_precificacao_completa['Preço de Venda (Mercado) (R$)'] = df_precificacao_completa['Preço de Venda (Mercado) (R$)'].fillna(0.0)
+    # 5. Busca dos preços de venda fixos (map no dicionário em vez de merge) e trata NaN (produtos sem preço definido)
+    df_precificacao_completa['Preço de Venda (Mercado) (R$)'] = df_precificacao_completa['PRODUTO'].map(preco_venda_dict).fillna(0.0)
     
     # 6. Calcular o Lucro Bruto (R$) e a Margem Percentual
-    
-    df_precificacao_completa['Custo Total de Insumos (R$)'] = df_precificacao_completa['Custo Total de Insumos (R$)'].replace(0, np.nan) 
+    # Máscaras NumPy no lugar de replace/fillna encadeados: produtos sem custo ou sem preço ficam com 0
+    custo = df_precificacao_completa['Custo Total de Insumos (R$)'].to_numpy(dtype=np.float64)
+    preco = df_precificacao_completa['Preço de Venda (Mercado) (R$)'].to_numpy(dtype=np.float64)
+    tem_custo = custo != 0
     
     # 6a. Lucro Bruto (R$)
-    df_precificacao_completa['Lucro Bruto (R$)'] = (
-        df_precificacao_completa['Preço de Venda (Mercado) (R$)'] - df_precificacao_completa['Custo Total de Insumos (R$)']
-    )
-    
-    # 6b. Margem Bruta (%) 
-    df_precificacao_completa['Margem Bruta (%)'] = (
-        df_precificacao_completa['Lucro Bruto (R$)'] / 
-        df_precificacao_completa['Preço de Venda (Mercado) (R$)']
-    ) * 100
+    lucro = np.where(tem_custo, preco - custo, 0.0)
     
+    # 6b. Margem Bruta (%)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        margem = np.where(tem_custo & (preco != 0), lucro / preco * 100, 0.0)
     
-    # TRATAMENTO DE ERROS DE CÁLCULO
-    for col in ['Lucro Bruto (R$)', 'Margem Bruta (%)']:
-        df_precificacao_completa[col] = df_precificacao_completa[col].replace([np.inf, -np.inf], np.nan)
-        df_precificacao_completa[col] = df_precificacao_completa[col].fillna(0.0)
-
-    df_precificacao_completa['Lucro Bruto (R$)'] = df_precificacao_completa['Lucro Bruto (R$)'].round(2) 
-    df_precificacao_completa['Margem Bruta (%)'] = df_precificacao_completa['Margem Bruta (%)'].round(1)
+    df_precificacao_completa['Lucro Bruto (R$)'] = lucro.round(2)
+    df_precificacao_completa['Margem Bruta (%)'] = margem.round(1)
 
     df_precificacao_completa = df_precificacao_completa.sort_values(by='Preço de Venda (Mercado) (R$)', ascending=False)
     
-    return df_precificacao_completa, custo_total_dict, df_bases_detalhe, df_finais_detalhe, unidade_ingredientes_dict, rendimento_bases
+    # 7. Pré-calcula as tabelas de exibição de cada produto (uma vez por carga, não a cada interação).
+    # Um dict para bases e outro para bolos finais: um bolo final pode ter o mesmo nome de uma base
+    base_details = {
+        base: build_base_display_frame(df_base)
+        for base, df_base in df_bases_detalhe.groupby('NOME_BASE', sort=False, observed=True)
+    }
+    final_details = {
+        bolo: build_final_display_frame(df_bolo, rendimento_bases)
+        for bolo, df_bolo in df_finais_detalhe.groupby('NOME_BOLO', sort=False, observed=True)
+    }
+    
+    # 8. Lista de produtos já ordenada para o seletor (ordenada uma vez por carga)
+    all_products_sorted = sorted(df_precificacao_completa['PRODUTO'].tolist())
+    
+    # 9. Tabela resumo da visão geral (recorte + renomeação feitos uma vez por carga)
+    df_display_summary = df_precificacao_completa[['PRODUTO', 'Tipo', 'Custo Total de Insumos (R$)', 'Preço de Venda (Mercado) (R$)', 'Lucro Bruto (R$)', 'Margem Bruta (%)']].rename(columns={
+        'PRODUTO': 'Produto',
+        'Custo Total de Insumos (R$)': 'Custo Insumos (R$)',
+        'Preço de Venda (Mercado) (R$)': 'Preço de Venda (R$)',
+    })
+    
+    # 10. Tipo e métricas de cada produto já em float e formatadas (as abas só fazem uma busca no dict).
+    # Um bolo final com o mesmo nome de uma base aparece em duas linhas: vale a primeira da tabela ordenada,
+    # a mesma que a busca por nome sempre mostrou (sem que a segunda sobrescreva a primeira no dict)
+    df_produtos_unicos = df_precificacao_completa.drop_duplicates(subset='PRODUTO')
+    product_metrics = {
+        produto: {
+            'tipo': tipo, 'custo': custo, 'preco': preco, 'lucro': lucro, 'margem': margem,
+            'custo_fmt': f"{custo:,.2f}", 'preco_fmt': f"{preco:,.2f}", 'lucro_fmt': f"{lucro:,.2f}", 'margem_fmt': f"{margem:,.1f}",
+        }
+        for produto, tipo, custo, preco, lucro, margem in zip(
+            df_produtos_unicos['PRODUTO'].tolist(),
+            df_produtos_unicos['Tipo'].tolist(),
+            df_produtos_unicos['Custo Total de Insumos (R$)'].tolist(),
+            df_produtos_unicos['Preço de Venda (Mercado) (R$)'].tolist(),
+            df_produtos_unicos['Lucro Bruto (R$)'].tolist(),
+            df_produtos_unicos['Margem Bruta (%)'].tolist(),
+        )
+    }
+    
+    return custo_total_dict, rendimento_bases, base_details, final_details, all_products_sorted, df_display_summary, product_metrics
 
 # --- Streamlit App (Frontend) ---
 
-def display_recipe_detail(selected_product, df_precificacao_completa, df_finais_detalhe, custo_total_dict, df_bases_detalhe, unidade_ingredientes_dict, rendimento_bases):
+def display_recipe_detail(selected_product, product_metrics, base_details, final_details, custo_total_dict, rendimento_bases):
     """Mostra o detalhe completo da receita e custo do produto final ou da base."""
     
-    product_info = df_precificacao_completa[df_precificacao_completa['PRODUTO'] == selected_product].iloc[0]
-    product_type = product_info['Tipo']
+    product_type = product_metrics[selected_product]['tipo']
     
     st.subheader(f"Composição e Custo de Insumos: {selected_product}")
     st.caption(f"Tipo de Produto: **{product_type}**")
@@ -242,23 +355,14 @@ def display_recipe_detail(selected_product, df_precificacao_completa, df_finais_
         st.markdown("---")
         st.info("💡 **Análise de Dados:** Este produto é composto por Insumos Mestres e, possivelmente, Receitas Base (massas/coberturas).")
         
-        df_bolo = df_finais_detalhe[df_finais_detalhe['NOME_BOLO'] == selected_product].copy()
-        
-        df_bolo['Tipo de Item'] = df_bolo['NOME_INGREDIENTE'].apply(
-            lambda x: 'Base' if x in rendimento_bases else 'Ingrediente Mestre/Final'
-        )
-        df_bolo['Custo Total (R$)'] = df_bolo['CUSTO_ITEM'].round(4)
-        df_bolo['Custo Unitário'] = df_bolo['CUSTO_UNITARIO'].round(4)
-        
-        df_display = df_bolo[['NOME_INGREDIENTE', 'QUANT_RECEITA', 'Tipo de Item', 'CUSTO_UNITARIO', 'Custo Total (R$)']]
-        df_display.columns = ['Item/Base Usada', 'Qtd na Receita', 'Tipo', 'Custo/Unidade Base (R$)', 'Custo Total do Item (R$)']
+        df_display = final_details[selected_product]
         
         st.dataframe(df_display, hide_index=True, use_container_width=True)
         
         total_custo = df_display['Custo Total do Item (R$)'].sum()
         st.metric("Custo Total de Insumos", f"R$ {total_custo:,.2f}")
         
-        bases_usadas = df_bolo[df_bolo['Tipo de Item'] == 'Base']['NOME_INGREDIENTE'].unique()
+        bases_usadas = df_display[df_display['Tipo'] == 'Base']['Item/Base Usada'].unique()
         
         if bases_usadas.size > 0:
             st.markdown("---")
@@ -267,41 +371,27 @@ def display_recipe_detail(selected_product, df_precificacao_completa, df_finais_
             for base in bases_usadas:
                 st.markdown(f"#### Composição da Base: {base}")
                 
-                df_base = df_bases_detalhe[df_bases_detalhe['NOME_BASE'] == base].copy()
-                
                 rendimento = rendimento_bases.get(base, 1)
                 custo_base_ajustado = custo_total_dict.get(base, 0)
                 
-                st.caption(f"Custo total da produção da Base {base}: R$ {df_base['CUSTO_ITEM'].sum():,.2f}. Rendimento: {rendimento} Unidade(s).")
+                st.caption(f"Custo total da produção da Base {base}: R$ {custo_base_ajustado * rendimento:,.2f}. Rendimento: {rendimento} Unidade(s).")
                 st.caption(f"Custo Ajustado por UNIDADE de Base usada no produto final: R$ {custo_base_ajustado:,.4f}.")
                 
-                df_base['Custo Total (R$)'] = df_base['CUSTO_ITEM'].round(4)
-                df_base['Custo/Unidade Mestre (R$)'] = df_base['CUSTO_UNITARIO'].round(4)
-
-                df_base_display = df_base[['NOME_INGREDIENTE', 'QUANT_RECEITA', 'Custo/Unidade Mestre (R$)', 'Custo Total (R$)']]
-                df_base_display.columns = ['Ingrediente Mestre', 'Qtd na Receita (G/ML/UN)', 'Custo/Unidade (R$)', 'Custo Total na Base (R$)']
-                
-                st.dataframe(df_base_display, hide_index=True, use_container_width=True)
+                st.dataframe(base_details[base], hide_index=True, use_container_width=True)
 
     elif 'Bolo Comum' in product_type:
         st.markdown("---")
         st.info("💡 **Análise de Dados:** Este produto (massa pura) é composto **diretamente** por Insumos Mestres.")
         
         base = selected_product
-        df_base = df_bases_detalhe[df_bases_detalhe['NOME_BASE'] == base].copy()
+        df_base_display = base_details[base]
         
         rendimento = rendimento_bases.get(base, 1)
         custo_base_ajustado = custo_total_dict.get(base, 0)
         
-        st.caption(f"Custo total da produção da Base {base}: R$ {df_base['CUSTO_ITEM'].sum():,.2f}. Rendimento: {rendimento} Unidade(s).")
+        st.caption(f"Custo total da produção da Base {base}: R$ {custo_base_ajustado * rendimento:,.2f}. Rendimento: {rendimento} Unidade(s).")
         st.caption(f"Custo Ajustado por UNIDADE (bolo/base) para o cálculo final: R$ {custo_base_ajustado:,.4f}.")
         
-        df_base['Custo Total (R$)'] = df_base['CUSTO_ITEM'].round(4)
-        df_base['Custo/Unidade Mestre (R$)'] = df_base['CUSTO_UNITARIO'].round(4)
-
-        df_base_display = df_base[['NOME_INGREDIENTE', 'QUANT_RECEITA', 'Custo/Unidade Mestre (R$)', 'Custo Total (R$)']]
-        df_base_display.columns = ['Ingrediente Mestre', 'Qtd na Receita (G/ML/UN)', 'Custo/Unidade (R$)', 'Custo Total na Base (R$)']
-        
         st.dataframe(df_base_display, hide_index=True, use_container_width=True)
         
         total_custo = df_base_display['Custo Total na Base (R$)'].sum() / rendimento
@@ -315,21 +405,30 @@ def main():
     col_refresh, col_title = st.columns([1, 4])
     with col_refresh:
         # **BOTÃO DE ATUALIZAR**
-        # Quando clicado, ele limpa o cache principal e força uma re-execução do script
+        # Quando clicado, ele limpa os caches (memória e disco) e força uma re-execução do script
         if st.button("🔄 Atualizar Dados Agora", help="Busca os dados mais recentes do Google Sheets e recalcula todos os custos."):
-            load_data_from_gsheets.clear()
+            get_sheet_revision.clear()
+            load_all_sheets.clear()
+            get_all_calculated_data.clear()
             st.rerun()
     
     col_title.info("A página é atualizada automaticamente ao ser aberta e quando o botão 'Atualizar Dados Agora' é pressionado.")
     st.markdown("---")
             
+    # Configuração incompleta: avisa antes de qualquer chamada ao Google (sem spinner, sem tentativas de conexão)
+    missing_config = [nome for nome, valor in [('SHEET_ID', SHEET_ID), ('GCP_SA_CLIENT_EMAIL', CLIENT_EMAIL), ('GCP_SA_PRIVATE_KEY', PRIVATE_KEY)] if not valor]
+    if missing_config:
+        st.error(f"Erro de configuração: Credenciais do Google Cloud não encontradas. Variáveis de ambiente não definidas: {', '.join(missing_config)}.")
+        return
+            
     # --- 1. Carregar Dados ---
     # Este bloco SEMPRE será executado na abertura (início) ou após um st.rerun
     with st.spinner('Ligando a IA da Precificação e buscando os dados no Sheets...'):
         try:
-            # Chama a função que fará a busca no Sheets (pois o cache foi removido ou não usado)
-            df_precificacao_completa, custo_total_dict, df_bases_detalhe, df_finais_detalhe, unidade_ingredientes_dict, rendimento_bases = get_all_calculated_data()
-            all_products = df_precificacao_completa['PRODUTO'].tolist()
+            # Chama a função que fará a busca no Sheets (ou lê o cache, se ainda válido)
+            sheet_revision = get_sheet_revision()
+            discard_stale_sheet_caches(sheet_revision)
+            custo_total_dict, rendimento_bases, base_details, final_details, all_products_sorted, df_display_summary, product_metrics = get_all_calculated_data(sheet_revision)
             
         except Exception as e:
             st.error(f"Não foi possível carregar ou calcular os dados. Verifique o checklist abaixo. Erro: {e}")
@@ -349,12 +448,20 @@ def main():
     st.success("Cálculos concluídos! Utilize o seletor abaixo para a análise detalhada.")
     st.markdown("---")
     
+    display_product_analysis(all_products_sorted, df_display_summary, product_metrics, base_details, final_details, custo_total_dict, rendimento_bases)
+
+# Fragmento: interações com o seletor re-executam apenas esta parte da página,
+# sem refazer o cabeçalho, o botão de atualizar e a leitura dos dados em cache
+@st.fragment
+def display_product_analysis(all_products_sorted, df_display_summary, product_metrics, base_details, final_details, custo_total_dict, rendimento_bases):
+    """Mostra o seletor de produtos, a visão geral e a análise de margem do produto escolhido."""
+    
     # --- 2. Interface de Consulta ---
     st.header("Análise de Preço e Margem")
     
     selected_product = st.selectbox(
         "Selecione o Produto para Análise Detalhada:",
-        options=["Selecione um Produto..."] + sorted(all_products)
+        options=["Selecione um Produto..."] + all_products_sorted
     )
     
     if selected_product == "Selecione um Produto...":
@@ -362,10 +469,7 @@ def main():
         
         st.subheader("Visão Geral de Lucro Bruto e Margem Percentual")
         
-        # Tabela resumo
-        df_display_summary = df_precificacao_completa[['PRODUTO', 'Tipo', 'Custo Total de Insumos (R$)', 'Preço de Venda (Mercado) (R$)', 'Lucro Bruto (R$)', 'Margem Bruta (%)']]
-        df_display_summary.columns = ['Produto', 'Tipo', 'Custo Insumos (R$)', 'Preço de Venda (R$)', 'Lucro Bruto (R$)', 'Margem Bruta (%)']
-        
+        # Tabela resumo (já montada em get_all_calculated_data)
         st.dataframe(df_display_summary, hide_index=True, use_container_width=True)
         return
         
@@ -375,31 +479,23 @@ def main():
         
         # --- TAB 1: CUSTO E PREÇO FINAL ---
         with tab1:
-            product_data = df_precificacao_completa[df_precificacao_completa['PRODUTO'] == selected_product].iloc[0]
-            
-            custo_produto = product_data['Custo Total de Insumos (R$)']
-            preco_venda = product_data['Preço de Venda (Mercado) (R$)']
-            
-            # TRATAMENTO DE TIPAGEM: Forçar para float
-            try:
-                lucro_bruto = float(product_data['Lucro Bruto (R$)'])
-            except:
-                lucro_bruto = 0.0
+            # Valores já convertidos para float e formatados em get_all_calculated_data
+            metrics = product_metrics[selected_product]
             
-            try:
-                margem_percentual = float(product_data['Margem Bruta (%)'])
-            except:
-                margem_percentual = 0.0
+            preco_venda = metrics['preco']
+            lucro_bruto = metrics['lucro']
+            margem_percentual = metrics['margem']
+            custo_fmt, preco_fmt, lucro_fmt, margem_fmt = metrics['custo_fmt'], metrics['preco_fmt'], metrics['lucro_fmt'], metrics['margem_fmt']
 
             # Três colunas para as métricas principais
             col1, col2, col3 = st.columns(3)
-            col1.metric("Custo Total de Insumos (Seu Custo)", f"R$ {custo_produto:,.2f}")
-            col2.metric("Preço de Venda (Seu Mercado)", f"R$ {preco_venda:,.2f}")
+            col1.metric("Custo Total de Insumos (Seu Custo)", f"R$ {custo_fmt}")
+            col2.metric("Preço de Venda (Seu Mercado)", f"R$ {preco_fmt}")
             
             # --- CÁLCULO DO LUCRO BRUTO EM R$ ---
             col3.metric(
                 label="Lucro Bruto (R$)", 
-                value=f"R$ {lucro_bruto:,.2f}", 
+                value=f"R$ {lucro_fmt}", 
                 delta=lucro_bruto,
                 delta_color='normal' 
             )
@@ -416,7 +512,7 @@ def main():
             
             st.markdown("---")
             st.markdown(f"#### Margem de Lucro Bruta: {margem_color}")
-            st.subheader(f"**{margem_percentual:,.1f} %**")
+            st.subheader(f"**{margem_fmt} %**")
 
             
             st.markdown("---")
@@ -426,7 +522,7 @@ def main():
                  st.error("🚨 **ALERTA DE DADOS:** Este produto não possui preço de venda definido na sua tabela de preços. O lucro não pode ser calculado.")
             else:
                 st.info(f"""
-                Você está utilizando o preço de venda de **R$ {preco_venda:,.2f}** para este produto, que tem um custo de insumos de **R$ {custo_produto:,.2f}**.
+                Você está utilizando o preço de venda de **R$ {preco_fmt}** para este produto, que tem um custo de insumos de **R$ {custo_fmt}**.
                 
                 #### 1. Lucro Bruto (Subtração Simples):
                 """)
@@ -434,7 +530,7 @@ def main():
                     \text{Lucro Bruto (R\$)} = \text{Preço de Venda} - \text{Custo Total}
                 """)
                 st.latex(f"""
-                    \text{{Lucro Bruto (R\$)}} = \text{{R\$ {preco_venda:,.2f}}} - \text{{R\$ {custo_produto:,.2f}}} = \mathbf{{\text{{R\$ {lucro_bruto:,.2f}}}}}
+                    \text{{Lucro Bruto (R\$)}} = \text{{R\$ {preco_fmt}}} - \text{{R\$ {custo_fmt}}} = \mathbf{{\text{{R\$ {lucro_fmt}}}}}
                 """)
                 
                 st.info(f"""
@@ -444,7 +540,7 @@ def main():
                     \text{Margem Bruta (\%)} = \frac{\text{Lucro Bruto}}{\text{Preço de Venda}} \times 100
                 """)
                 st.latex(f"""
-                    \text{{Margem Bruta (\\%)}} = \\frac{{\text{{R\$ {lucro_bruto:,.2f}}}}}{{\text{{R\$ {preco_venda:,.2f}}}}} \times 100 = \mathbf{{ {margem_percentual:,.1f}\% }}
+                    \text{{Margem Bruta (\\%)}} = \\frac{{\text{{R\$ {lucro_fmt}}}}}{{\text{{R\$ {preco_fmt}}}}} \times 100 = \mathbf{{ {margem_fmt}\% }}
                 """)
                 
                 st.info("""
@@ -453,7 +549,7 @@ def main():
 
         # --- TAB 2: DETALHE DA RECEITA ---
         with tab2:
-            display_recipe_detail(selected_product, df_precificacao_completa, df_finais_detalhe, custo_total_dict, df_bases_detalhe, unidade_ingredientes_dict, rendimento_bases)
+            display_recipe_detail(selected_product, product_metrics, base_details, final_details, custo_total_dict, rendimento_bases)
 
 if __name__ == '__main__':
     main()